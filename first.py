@@ -1,25 +1,34 @@
 import parlant.sdk as p
 import asyncio
-import uuid
-from datetime import datetime
+import functools
+import re
+import secrets
+import textwrap
+import time
+from collections.abc import Iterable, Iterator, Mapping
+from dataclasses import dataclass
+from types import MappingProxyType
 import logging # Import standard logging
+from cachetools import LRUCache
 from dotenv import load_dotenv # Added to potentially load API keys
 
 load_dotenv() # Load environment variables from .env file if it exists
 
 # Configure standard Python logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 
 # --- 1. Mock Data (Simulated Pharmacy Systems) ---
-mock_inventory = {
+# Seed data; the public names below are read-only views built from it.
+_INVENTORY_SEED = {
     "Paracetamol 500mg Tablets": {"stock": 100, "requires_prescription": False},
     "Amoxicillin 250mg Capsules": {"stock": 50, "requires_prescription": True},
     "Ibuprofen 200mg Tablets": {"stock": 0, "requires_prescription": False},
     "Lisinopril 10mg Tablets": {"stock": 75, "requires_prescription": True},
 }
 
-mock_drug_info = {
+_DRUG_INFO_SEED = {
     "Paracetamol 500mg Tablets": {
         "usage": "For mild to moderate pain relief and fever reduction.",
         "side_effects": "Generally well-tolerated. Rare side effects include allergic reactions.",
@@ -40,46 +49,128 @@ mock_drug_info = {
     }
 }
 
-mock_orders = {} # Store simulated orders {order_id: details}
-mock_prescriptions = {"RX12345": True, "RX67890": False} # Simple valid/invalid check
+@dataclass(slots=True)
+class OrderRecord:
+    """A simulated order, as stored in `mock_orders`."""
+    medication: str
+    quantity: int
+    prescription_ref: str | None
+    status: str
+    timestamp: int # Nanoseconds since the epoch (time.time_ns())
+
+mock_orders: LRUCache[str, OrderRecord] = LRUCache(maxsize=10_000) # Store simulated orders {order_id: OrderRecord}, evicting the least recently used
+_PRESCRIPTIONS_SEED = {"RX12345": True, "RX67890": False} # Simple valid/invalid check
+# Prescription refs are normalized to uppercase before lookup, so keys must be stored uppercase
+assert all(ref == ref.upper() for ref in _PRESCRIPTIONS_SEED)
+
+# Live inventory, split by field: stock counts change as orders are placed,
+# prescription requirements never do.
+_stock: dict[str, int] = {name: data["stock"] for name, data in _INVENTORY_SEED.items()}
+_requires_rx = frozenset(name for name, data in _INVENTORY_SEED.items() if data["requires_prescription"])
+stock_levels = MappingProxyType(_stock) # Read-only view of the live stock counts
+
+# Read-only catalogs, records included. Inventory records hold only the fixed
+# fields ("requires_prescription"); live counts are in `stock_levels`.
+# `mock_prescriptions` must stay fixed because `_verify_rx` caches its lookups.
+mock_inventory: Mapping[str, Mapping[str, bool]] = MappingProxyType({
+    name: MappingProxyType({"requires_prescription": bool(data["requires_prescription"])})
+    for name, data in _INVENTORY_SEED.items()
+})
+mock_drug_info: Mapping[str, Mapping[str, str]] = MappingProxyType(
+    {name: MappingProxyType(data) for name, data in _DRUG_INFO_SEED.items()}
+)
+mock_prescriptions: Mapping[str, bool] = MappingProxyType(_PRESCRIPTIONS_SEED)
+
+# --- Medication Name Lookup ---
+# Lowercase lookup indexes, built once. The catalogs are frozen, so these
+# stay in sync with the mock data.
+
+def _substrings(text: str) -> Iterator[str]:
+    """Yields every non-empty substring of `text`."""
+    for start in range(len(text)):
+        for end in range(start + 1, len(text) + 1):
+            yield text[start:end]
+
+def _build_substring_index(names: Iterable[str]) -> dict[str, str]:
+    """Maps every lowercase substring to the first name (in catalog order) containing it."""
+    index: dict[str, str] = {}
+    for name in names:
+        for token in _substrings(name.lower()):
+            index.setdefault(token, name)
+    return index
+
+_inventory_lower = {name.lower(): name for name in mock_inventory}
+_inventory_substr = _build_substring_index(mock_inventory)
+_drug_info_lower = {name.lower(): name for name in mock_drug_info}
+_drug_info_substr = _build_substring_index(mock_drug_info)
+
+def _resolve_medication(medication_name: str, lower_map: Mapping[str, str], substr_index: Mapping[str, str]) -> str | None:
+    """Resolves a medication name case-insensitively, ignoring surrounding whitespace,
+    and preferring an exact match over a partial one."""
+    query = medication_name.strip().lower()
+    return lower_map.get(query) or substr_index.get(query)
+
+def _render_drug_info(name: str, info_data: Mapping) -> str:
+    """Formats the approved information for a medication, including the disclaimer."""
+    info_string = f"Information for '{name}':\n"
+    info_string += f"- Usage: {info_data.get('usage', 'N/A')}\n"
+    info_string += f"- Common Side Effects: {info_data.get('side_effects', 'N/A')}\n"
+    info_string += f"- Contraindications: {info_data.get('contraindications', 'N/A')}\n"
+    info_string += f"- Notes: {info_data.get('notes', 'N/A')}\n\n"
+    info_string += "**Disclaimer:** This is not medical advice. Always consult your doctor or pharmacist for medical guidance."
+    return info_string
+
+# Drug info never changes at runtime, so each feedback string is rendered once.
+_drug_info_formatted = {name: _render_drug_info(name, data) for name, data in mock_drug_info.items()}
+
+# check_stock feedback per medication. Names and Rx requirements are fixed, so only
+# the stock count is filled in (%d) per call; names are %-escaped for the template.
+_RX_STATUS = {True: "Requires prescription.", False: "Does not require prescription."}
+_stock_feedback_template = {
+    name: f"'{name.replace('%', '%%')}' is in stock (%d units available). {_RX_STATUS[name in _requires_rx]}"
+    for name in mock_inventory
+}
+_out_of_stock_feedback = {
+    name: f"'{name}' is currently out of stock. {_RX_STATUS[name in _requires_rx]}"
+    for name in mock_inventory
+}
+
+@functools.lru_cache(maxsize=1024)
+def _verify_rx(ref_upper: str) -> bool:
+    """Returns whether an (already uppercased) prescription reference is valid."""
+    return mock_prescriptions.get(ref_upper, False)
+
+@functools.lru_cache(maxsize=1024)
+def _format_status(order_id_upper: str, order_tuple: tuple[str, int, str]) -> str:
+    """Formats the feedback for an order given as (status, quantity, medication)."""
+    status, quantity, medication = order_tuple
+    return f"Order {order_id_upper} Status: {status}. Placed for {quantity}x '{medication}'."
 
 # --- 2. Tool Functions (Returning p.ToolResult) ---
 
 @p.tool
 async def check_stock(context: p.ToolContext, medication_name: str) -> p.ToolResult:
     """Checks the current stock level for a specific medication name."""
-    logging.info(f"Tool 'check_stock' called with medication_name: {medication_name}")
-    found_med = None
-    stock_data = None
-    for name, data in mock_inventory.items():
-        # Case-insensitive matching
-        if medication_name.lower() == name.lower():
-             found_med = name
-             stock_data = data
-             break
-        # Allow partial match as fallback, but prefer exact
-        elif medication_name.lower() in name.lower() and not found_med:
-            found_med = name
-            stock_data = data # Keep checking for exact match
-
-    if found_med and stock_data is not None:
-        stock = stock_data["stock"]
-        requires_rx = stock_data["requires_prescription"]
-        rx_status = "Requires prescription." if requires_rx else "Does not require prescription."
+    logger.info("Tool 'check_stock' called with medication_name: %s", medication_name)
+    found_med = _resolve_medication(medication_name, _inventory_lower, _inventory_substr)
+
+    if found_med:
+        stock = stock_levels[found_med]
+        requires_rx = found_med in _requires_rx
         if stock > 0:
-            logging.info(f"Stock check success for '{found_med}': {stock} units, Rx required: {requires_rx}")
+            logger.info("Stock check success for '%s': %s units, Rx required: %s", found_med, stock, requires_rx)
             return p.ToolResult(
                 data={"requires_prescription": requires_rx, "in_stock": True, "medication_name": found_med, "stock_count": stock},
-                metadata={"feedback": f"'{found_med}' is in stock ({stock} units available). {rx_status}"},
+                metadata={"feedback": _stock_feedback_template[found_med] % stock},
             )
         else:
-            logging.warning(f"Stock check failed for '{found_med}': Out of stock.")
+            logger.warning("Stock check failed for '%s': Out of stock.", found_med)
             return p.ToolResult(
                 data={"requires_prescription": requires_rx, "in_stock": False, "medication_name": found_med},
-                metadata={"feedback": f"'{found_med}' is currently out of stock. {rx_status}", "is_error": True},
+                metadata={"feedback": _out_of_stock_feedback[found_med], "is_error": True},
             )
     else:
-        logging.warning(f"Stock check failed: Medication '{medication_name}' not found.")
+        logger.warning("Stock check failed: Medication '%s' not found.", medication_name)
         return p.ToolResult(
             data={"medication_found": False},
             metadata={"feedback": f"Sorry, I couldn't find '{medication_name}' in our inventory system.", "is_error": True},
@@ -89,29 +180,14 @@ async def check_stock(context: p.ToolContext, medication_name: str) -> p.ToolRes
 @p.tool
 async def get_drug_info(context: p.ToolContext, medication_name: str) -> p.ToolResult:
     """Provides approved information (usage, side effects, contraindications) about a medication."""
-    logging.info(f"Tool 'get_drug_info' called with medication_name: {medication_name}")
-    found_med = None
-    info_data = None
-    for name, data in mock_drug_info.items():
-         if medication_name.lower() == name.lower():
-             found_med = name
-             info_data = data
-             break
-         elif medication_name.lower() in name.lower() and not found_med:
-            found_med = name
-            info_data = data
-
-    if found_med and info_data is not None:
-        info_string = f"Information for '{found_med}':\n"
-        info_string += f"- Usage: {info_data.get('usage', 'N/A')}\n"
-        info_string += f"- Common Side Effects: {info_data.get('side_effects', 'N/A')}\n"
-        info_string += f"- Contraindications: {info_data.get('contraindications', 'N/A')}\n"
-        info_string += f"- Notes: {info_data.get('notes', 'N/A')}\n\n"
-        info_string += "**Disclaimer:** This is not medical advice. Always consult your doctor or pharmacist for medical guidance."
-        logging.info(f"Drug info found for '{found_med}'.")
-        return p.ToolResult(data={"info_found": True}, metadata={"feedback": info_string})
+    logger.info("Tool 'get_drug_info' called with medication_name: %s", medication_name)
+    found_med = _resolve_medication(medication_name, _drug_info_lower, _drug_info_substr)
+
+    if found_med:
+        logger.info("Drug info found for '%s'.", found_med)
+        return p.ToolResult(data={"info_found": True}, metadata={"feedback": _drug_info_formatted[found_med]})
     else:
-        logging.warning(f"Drug info failed: Medication '{medication_name}' not found.")
+        logger.warning("Drug info failed: Medication '%s' not found.", medication_name)
         return p.ToolResult(
             data={"info_found": False},
             metadata={"feedback": f"Sorry, I don't have detailed information available for '{medication_name}'.", "is_error": True},
@@ -120,14 +196,14 @@ async def get_drug_info(context: p.ToolContext, medication_name: str) -> p.ToolR
 @p.tool
 async def verify_prescription(context: p.ToolContext, prescription_ref: str) -> p.ToolResult:
     """Checks if a given prescription reference is valid in the system."""
-    logging.info(f"Tool 'verify_prescription' called with prescription_ref: {prescription_ref}")
+    logger.info("Tool 'verify_prescription' called with prescription_ref: %s", prescription_ref)
     ref_upper = prescription_ref.upper()
-    is_valid = mock_prescriptions.get(ref_upper, False)
+    is_valid = _verify_rx(ref_upper)
     if is_valid:
-        logging.info(f"Prescription '{ref_upper}' verified successfully.")
+        logger.info("Prescription '%s' verified successfully.", ref_upper)
         return p.ToolResult(data={"verified": True}, metadata={"feedback": f"Prescription '{ref_upper}' is valid."})
     else:
-        logging.warning(f"Prescription verification failed for '{ref_upper}'.")
+        logger.warning("Prescription verification failed for '%s'.", ref_upper)
         return p.ToolResult(
             data={"verified": False},
             metadata={"feedback": f"I couldn't verify prescription reference '{ref_upper}'. Please double-check the reference number.", "is_error": True},
@@ -141,58 +217,54 @@ async def place_order(
     prescription_ref: str | None = None
 ) -> p.ToolResult:
     """Places an order for a medication after checks. Requires quantity. Prescription ref needed if drug requires it."""
-    logging.info(f"Tool 'place_order' called: med='{medication_name}', qty={quantity}, rx='{prescription_ref}'")
-    found_med = None
-    stock_data = None
-    for name, data in mock_inventory.items():
-         if medication_name.lower() == name.lower(): # Prioritize exact match
-             found_med = name
-             stock_data = data
-             break
-         elif medication_name.lower() in name.lower() and not found_med:
-            found_med = name
-            stock_data = data
-
-    if not found_med or stock_data is None:
-        logging.error(f"Order placement failed: Medication '{medication_name}' not found.")
-        return p.ToolResult(data={"order_placed": False, "reason": "Medication not found"}, metadata={"feedback": f"Cannot place order. Medication '{medication_name}' not found.", "is_error": True})
+    logger.info("Tool 'place_order' called: med='%s', qty=%s, rx='%s'", medication_name, quantity, prescription_ref)
+    found_med = _resolve_medication(medication_name, _inventory_lower, _inventory_substr)
 
-    try:
-        quantity_int = int(quantity)
-        if quantity_int <= 0:
-            raise ValueError("Quantity must be positive")
-    except (ValueError, TypeError):
-         logging.error(f"Order placement failed for '{found_med}': Invalid quantity '{quantity}'.")
-         return p.ToolResult(data={"order_placed": False, "reason": "Invalid quantity"}, metadata={"feedback": f"Cannot place order. Please provide a valid positive number for the quantity.", "is_error": True})
-
-    if stock_data["stock"] < quantity_int:
-        logging.error(f"Order placement failed for '{found_med}': Insufficient stock (needed {quantity_int}, have {stock_data['stock']}).")
-        return p.ToolResult(data={"order_placed": False, "reason": "Insufficient stock"}, metadata={"feedback": f"Cannot place order. Insufficient stock for '{found_med}'. Available: {stock_data['stock']}.", "is_error": True})
+    if not found_med:
+        logger.error("Order placement failed: Medication '%s' not found.", medication_name)
+        return p.ToolResult(data={"order_placed": False, "reason": "Medication not found"}, metadata={"feedback": f"Cannot place order. Medication '{medication_name}' not found.", "is_error": True})
 
+    # Cheapest validators first: prescription checks don't need the quantity or stock
     prescription_ref_upper = prescription_ref.upper() if prescription_ref else None
 
-    if stock_data["requires_prescription"]:
+    if found_med in _requires_rx:
         if not prescription_ref_upper:
-            logging.error(f"Order placement failed for '{found_med}': Missing required prescription ref.")
+            logger.error("Order placement failed for '%s': Missing required prescription ref.", found_med)
             return p.ToolResult(data={"order_placed": False, "reason": "Missing prescription"}, metadata={"feedback": f"Cannot place order. '{found_med}' requires a prescription reference, but none was provided.", "is_error": True})
-        is_valid_rx = mock_prescriptions.get(prescription_ref_upper, False)
+        is_valid_rx = _verify_rx(prescription_ref_upper)
         if not is_valid_rx:
-             logging.error(f"Order placement failed for '{found_med}': Prescription '{prescription_ref_upper}' failed verification.")
+             logger.error("Order placement failed for '%s': Prescription '%s' failed verification.", found_med, prescription_ref_upper)
              return p.ToolResult(data={"order_placed": False, "reason": "Prescription invalid"}, metadata={"feedback": f"Cannot place order. Prescription reference '{prescription_ref_upper}' could not be verified.", "is_error": True})
     elif prescription_ref_upper:
-         logging.warning(f"Note: Prescription '{prescription_ref_upper}' provided for non-prescription item '{found_med}'.")
+         logger.warning("Note: Prescription '%s' provided for non-prescription item '%s'.", prescription_ref_upper, found_med)
+
+    try:
+        quantity_int = int(quantity)
+        if quantity_int <= 0:
+            raise ValueError("Quantity must be positive")
+    except (ValueError, TypeError):
+         logger.error("Order placement failed for '%s': Invalid quantity '%s'.", found_med, quantity)
+         return p.ToolResult(data={"order_placed": False, "reason": "Invalid quantity"}, metadata={"feedback": f"Cannot place order. Please provide a valid positive number for the quantity.", "is_error": True})
+
+    # Nothing is awaited between the stock check and the decrement below, so
+    # concurrent orders can't interleave there and oversell.
+    stock = stock_levels[found_med]
+    if stock < quantity_int:
+        logger.error("Order placement failed for '%s': Insufficient stock (needed %s, have %s).", found_med, quantity_int, stock)
+        return p.ToolResult(data={"order_placed": False, "reason": "Insufficient stock"}, metadata={"feedback": f"Cannot place order. Insufficient stock for '{found_med}'. Available: {stock}.", "is_error": True})
 
     # Simulate placing order
-    order_id = str(uuid.uuid4())[:8].upper()
-    mock_orders[order_id] = {
-        "medication": found_med,
-        "quantity": quantity_int,
-        "prescription_ref": prescription_ref_upper,
-        "status": "Processing",
-        "timestamp": datetime.now().isoformat()
-    }
-    mock_inventory[found_med]["stock"] -= quantity_int
-    logging.info(f"Order placed successfully for {quantity_int}x '{found_med}'. Order ID: {order_id}. New stock: {mock_inventory[found_med]['stock']}")
+    order_id = secrets.token_hex(4).upper()
+    mock_orders[order_id] = OrderRecord(
+        medication=found_med,
+        quantity=quantity_int,
+        prescription_ref=prescription_ref_upper,
+        status="Processing",
+        timestamp=time.time_ns(),
+    )
+    _stock[found_med] -= quantity_int
+    new_stock = stock_levels[found_med]
+    logger.info("Order placed successfully for %sx '%s'. Order ID: %s. New stock: %s", quantity_int, found_med, order_id, new_stock)
 
     return p.ToolResult(
         data={"order_placed": True, "order_id": order_id},
@@ -203,14 +275,15 @@ async def place_order(
 @p.tool
 async def check_order_status(context: p.ToolContext, order_id: str) -> p.ToolResult:
     """Checks the status of an existing order using its Order ID."""
-    logging.info(f"Tool 'check_order_status' called with order_id: {order_id}")
+    logger.info("Tool 'check_order_status' called with order_id: %s", order_id)
     order_id_upper = order_id.upper()
     order = mock_orders.get(order_id_upper)
     if order:
-        logging.info(f"Order status found for '{order_id_upper}': {order['status']}")
-        return p.ToolResult(data={"status_found": True}, metadata={"feedback": f"Order {order_id_upper} Status: {order['status']}. Placed for {order['quantity']}x '{order['medication']}'."})
+        logger.info("Order status found for '%s': %s", order_id_upper, order.status)
+        feedback = _format_status(order_id_upper, (order.status, order.quantity, order.medication))
+        return p.ToolResult(data={"status_found": True}, metadata={"feedback": feedback})
     else:
-        logging.warning(f"Order status check failed: Order ID '{order_id_upper}' not found.")
+        logger.warning("Order status check failed: Order ID '%s' not found.", order_id_upper)
         return p.ToolResult(
             data={"status_found": False},
             metadata={"feedback": f"Sorry, I could not find an order with ID '{order_id_upper}'. Please check the ID.", "is_error": True},
@@ -218,18 +291,53 @@ async def check_order_status(context: p.ToolContext, order_id: str) -> p.ToolRes
 
 # --- 3. Journey Creation Functions ---
 
+def _first_leaf(group: BaseExceptionGroup) -> BaseException:
+    """Returns the first non-group exception nested in an exception group."""
+    exc: BaseException = group
+    while isinstance(exc, BaseExceptionGroup):
+        exc = exc.exceptions[0]
+    return exc
+
+async def _gather(*aws):
+    """Runs awaitables concurrently and returns their results in order. If one fails, the
+    rest are cancelled and its exception is re-raised (chained from the task group's
+    `ExceptionGroup`), so callers see the actual error."""
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(aw) for aw in aws]
+    except BaseExceptionGroup as group:
+        raise _first_leaf(group) from group
+    return [task.result() for task in tasks]
+
+# Journey trigger conditions, built once. create_journey only reads them, so the
+# lists are passed as-is rather than copied per call.
+_ORDER_CONDITIONS: list[str | p.Guideline] = [
+    "customer wants to order a medication",
+    "buy medicine",
+    "need to purchase a drug",
+]
+_INFO_CONDITIONS: list[str | p.Guideline] = [
+    "customer wants information about a drug",
+    "tell me about medication",
+    "side effects of",
+    "how to use medicine",
+]
+_STATUS_CONDITIONS: list[str | p.Guideline] = [
+    "customer wants to check order status",
+    "where is my order",
+    "status of order",
+]
+
 async def create_new_order_journey(agent: p.Agent):
     """Creates the journey for placing a new medication order."""
     journey = await agent.create_journey(
         title="Place New Medication Order",
         description="Guides the customer through placing a new order for medication.",
-        conditions=[
-            "customer wants to order a medication",
-            "buy medicine",
-            "need to purchase a drug"
-        ]
+        conditions=_ORDER_CONDITIONS
     )
-    # Define states and transitions using the healthcare.py pattern
+    # Define states and transitions using the healthcare.py pattern.
+    # Transitions only depend on the state they start from, so sibling
+    # transitions are created concurrently, one dependency level at a time.
     t0 = await journey.initial_state.transition_to(
         chat_state="Ask which medication the customer needs."
     )
@@ -239,84 +347,90 @@ async def create_new_order_journey(agent: p.Agent):
     # State after stock check
     state_after_stock_check = t1.target
 
-    # Path if Rx is needed
-    t2_rx = await state_after_stock_check.transition_to(
-        chat_state="Ask for the prescription reference number as the medication requires it.",
-        condition="The tool 'check_stock' result data indicates 'requires_prescription' is true AND 'in_stock' is true" # Condition based on tool output data
+    t2_rx, t4_qty_no_rx, t_error_stock, t_error_notfound = await _gather(
+        # Path if Rx is needed
+        state_after_stock_check.transition_to(
+            chat_state="Ask for the prescription reference number as the medication requires it.",
+            condition="The tool 'check_stock' result data indicates 'requires_prescription' is true AND 'in_stock' is true" # Condition based on tool output data
+        ),
+        # Path if Rx is NOT needed (and in stock)
+        state_after_stock_check.transition_to(
+            chat_state="Ask how many units the customer would like to order (e.g., number of tablets/capsules).",
+            condition="The tool 'check_stock' result data indicates 'requires_prescription' is false AND 'in_stock' is true"
+        ),
+        # --- Error Handling Transitions ---
+        # Out of stock error (from state_after_stock_check)
+        state_after_stock_check.transition_to(
+            chat_state="Inform the customer the medication is out of stock and ask if they want alternatives discussed with a pharmacist.",
+            condition="The tool 'check_stock' result data indicates 'in_stock' is false"
+        ),
+        # Medication not found error (from state_after_stock_check)
+        state_after_stock_check.transition_to(
+            chat_state="Inform the customer the medication was not found in the system and ask them to verify the spelling or try another name.",
+            condition="The tool 'check_stock' result data indicates 'medication_found' is false"
+        ),
     )
-    t3_verify = await t2_rx.target.transition_to(
-        tool_state=verify_prescription # Execute verify_prescription tool
+    state_ask_qty_no_rx = t4_qty_no_rx.target # State asking for quantity (No Rx path)
+
+    t3_verify, _, _ = await _gather(
+        t2_rx.target.transition_to(
+            tool_state=verify_prescription # Execute verify_prescription tool
+        ),
+        t_error_stock.target.transition_to(state=p.END_JOURNEY), # End after informing
+        t_error_notfound.target.transition_to(state=p.END_JOURNEY), # End after informing
     )
     state_after_verify = t3_verify.target # State after prescription verification attempt
 
-    t4_qty_rx = await state_after_verify.transition_to(
-        chat_state="Ask how many units the customer would like to order (e.g., number of tablets/capsules).",
-        condition="The tool 'verify_prescription' result data indicates 'verified' is true"
+    t4_qty_rx, t_error_rx = await _gather(
+        state_after_verify.transition_to(
+            chat_state="Ask how many units the customer would like to order (e.g., number of tablets/capsules).",
+            condition="The tool 'verify_prescription' result data indicates 'verified' is true"
+        ),
+        # Invalid prescription error (from state_after_verify)
+        state_after_verify.transition_to(
+            chat_state="Inform the customer the prescription reference could not be verified and ask them to check or contact support.",
+            condition="The tool 'verify_prescription' result data indicates 'verified' is false"
+        ),
     )
     state_ask_qty_rx = t4_qty_rx.target # State asking for quantity (Rx path)
 
-    # Path if Rx is NOT needed (and in stock)
-    t4_qty_no_rx = await state_after_stock_check.transition_to(
-        chat_state="Ask how many units the customer would like to order (e.g., number of tablets/capsules).",
-        condition="The tool 'check_stock' result data indicates 'requires_prescription' is false AND 'in_stock' is true"
-    )
-    state_ask_qty_no_rx = t4_qty_no_rx.target # State asking for quantity (No Rx path)
-
     # --- Refactored Part ---
     # The SDK no longer exposes `journey.create_state` publicly. Create the
     # shared `place_order` state by creating it from one of the quantity states
     # (this will return the created state), then point the other quantity path
     # at that same state using `transition_to(state=...)`.
-    t_place_from_rx = await state_ask_qty_rx.transition_to(
-        tool_state=place_order,
-        condition="User provides a valid quantity"
+    t_place_from_rx, _ = await _gather(
+        state_ask_qty_rx.transition_to(
+            tool_state=place_order,
+            condition="User provides a valid quantity"
+        ),
+        t_error_rx.target.transition_to(state=p.END_JOURNEY), # End after informing
     )
     state_place_order = t_place_from_rx.target
 
-    # Reuse the same place_order state for the no-Rx path
-    await state_ask_qty_no_rx.transition_to(
-        state=state_place_order,
-        condition="User provides a valid quantity"
+    _, t6_confirm, t_error_order = await _gather(
+        # Reuse the same place_order state for the no-Rx path
+        state_ask_qty_no_rx.transition_to(
+            state=state_place_order,
+            condition="User provides a valid quantity"
+        ),
+        # Transitions *from* the place_order state (state_place_order is now the correct object)
+        state_place_order.transition_to(
+             chat_state="Confirm the order placement and provide the Order ID.",
+             condition="The tool 'place_order' result data indicates 'order_placed' is true"
+        ),
+        # Order placement error (from state_place_order)
+        state_place_order.transition_to(
+            chat_state="Inform the customer the order could not be placed due to an issue (e.g., stock changed, invalid quantity) and suggest trying again or contacting support. Provide reason if available from tool feedback.",
+            condition="The tool 'place_order' result data indicates 'order_placed' is false"
+        ),
     )
     # --- End of Refactored Part ---
 
-    # Transitions *from* the place_order state (state_place_order is now the correct object)
-    t6_confirm = await state_place_order.transition_to(
-         chat_state="Confirm the order placement and provide the Order ID.",
-         condition="The tool 'place_order' result data indicates 'order_placed' is true"
+    await _gather(
+        t6_confirm.target.transition_to(state=p.END_JOURNEY), # End journey after confirmation
+        t_error_order.target.transition_to(state=p.END_JOURNEY), # End after informing
     )
-    # End journey after confirmation
-    await t6_confirm.target.transition_to(state=p.END_JOURNEY)
-
-
-    # --- Error Handling Transitions ---
-    # Out of stock error (from state_after_stock_check)
-    t_error_stock = await state_after_stock_check.transition_to(
-        chat_state="Inform the customer the medication is out of stock and ask if they want alternatives discussed with a pharmacist.",
-        condition="The tool 'check_stock' result data indicates 'in_stock' is false"
-    )
-    await t_error_stock.target.transition_to(state=p.END_JOURNEY) # End after informing
-
-     # Medication not found error (from state_after_stock_check)
-    t_error_notfound = await state_after_stock_check.transition_to(
-        chat_state="Inform the customer the medication was not found in the system and ask them to verify the spelling or try another name.",
-        condition="The tool 'check_stock' result data indicates 'medication_found' is false"
-    )
-    await t_error_notfound.target.transition_to(state=p.END_JOURNEY) # End after informing
-
-    # Invalid prescription error (from state_after_verify)
-    t_error_rx = await state_after_verify.transition_to(
-        chat_state="Inform the customer the prescription reference could not be verified and ask them to check or contact support.",
-        condition="The tool 'verify_prescription' result data indicates 'verified' is false"
-    )
-    await t_error_rx.target.transition_to(state=p.END_JOURNEY) # End after informing
-
-    # Order placement error (from state_place_order)
-    t_error_order = await state_place_order.transition_to(
-        chat_state="Inform the customer the order could not be placed due to an issue (e.g., stock changed, invalid quantity) and suggest trying again or contacting support. Provide reason if available from tool feedback.",
-        condition="The tool 'place_order' result data indicates 'order_placed' is false"
-    )
-    await t_error_order.target.transition_to(state=p.END_JOURNEY) # End after informing
 
     # Add journey-specific guidelines if needed (like in healthcare example)
     # e.g., await journey.create_guideline(...)
@@ -328,12 +442,7 @@ async def create_drug_info_journey(agent: p.Agent):
     journey = await agent.create_journey(
         title="Get Medication Information",
         description="Provides approved information about a specific medication.",
-        conditions=[
-            "customer wants information about a drug",
-            "tell me about medication",
-            "side effects of",
-            "how to use medicine"
-        ]
+        conditions=_INFO_CONDITIONS
     )
     t0 = await journey.initial_state.transition_to(
         chat_state="Ask for the name of the medication the customer wants information about."
@@ -341,17 +450,20 @@ async def create_drug_info_journey(agent: p.Agent):
     t1 = await t0.target.transition_to(
         tool_state=get_drug_info # Execute get_drug_info tool
     )
-    t2_success = await t1.target.transition_to(
-        chat_state="Ask if the customer has any other questions or needs further assistance.",
-        condition="The tool 'get_drug_info' result data indicates 'info_found' is true"
+    t2_success, t2_fail = await _gather(
+        t1.target.transition_to(
+            chat_state="Ask if the customer has any other questions or needs further assistance.",
+            condition="The tool 'get_drug_info' result data indicates 'info_found' is true"
+        ),
+        t1.target.transition_to(
+            chat_state="Apologize for not having information and ask if they need help with something else.",
+            condition="The tool 'get_drug_info' result data indicates 'info_found' is false"
+        ),
     )
-    await t2_success.target.transition_to(state=p.END_JOURNEY) # End after asking
-
-    t2_fail = await t1.target.transition_to(
-        chat_state="Apologize for not having information and ask if they need help with something else.",
-        condition="The tool 'get_drug_info' result data indicates 'info_found' is false"
+    await _gather(
+        t2_success.target.transition_to(state=p.END_JOURNEY), # End after asking
+        t2_fail.target.transition_to(state=p.END_JOURNEY), # End after apologizing
     )
-    await t2_fail.target.transition_to(state=p.END_JOURNEY) # End after apologizing
 
     return journey
 
@@ -360,11 +472,7 @@ async def create_order_status_journey(agent: p.Agent):
     journey = await agent.create_journey(
         title="Check Order Status",
         description="Checks the status of an existing medication order.",
-        conditions=[
-            "customer wants to check order status",
-            "where is my order",
-            "status of order"
-        ]
+        conditions=_STATUS_CONDITIONS
     )
     t0 = await journey.initial_state.transition_to(
         chat_state="Ask for the Order ID."
@@ -372,71 +480,123 @@ async def create_order_status_journey(agent: p.Agent):
     t1 = await t0.target.transition_to(
         tool_state=check_order_status # Execute check_order_status tool
     )
-    t2_success = await t1.target.transition_to(
-        chat_state="Provide the order status and ask if further help is needed.",
-        condition="The tool 'check_order_status' result data indicates 'status_found' is true"
+    t2_success, t2_fail = await _gather(
+        t1.target.transition_to(
+            chat_state="Provide the order status and ask if further help is needed.",
+            condition="The tool 'check_order_status' result data indicates 'status_found' is true"
+        ),
+        t1.target.transition_to(
+            chat_state="Inform the customer the Order ID wasn't found and ask them to verify or contact support.",
+            condition="The tool 'check_order_status' result data indicates 'status_found' is false"
+        ),
     )
-    await t2_success.target.transition_to(state=p.END_JOURNEY)
-
-    t2_fail = await t1.target.transition_to(
-        chat_state="Inform the customer the Order ID wasn't found and ask them to verify or contact support.",
-        condition="The tool 'check_order_status' result data indicates 'status_found' is false"
+    await _gather(
+        t2_success.target.transition_to(state=p.END_JOURNEY),
+        t2_fail.target.transition_to(state=p.END_JOURNEY),
     )
-    await t2_fail.target.transition_to(state=p.END_JOURNEY)
 
     return journey
 
+# Glossary terms as (name, description) pairs
+_TERMS = [
+    ("Prescription", "An instruction written by a medical practitioner that authorizes a patient to be provided a medicine or treatment."),
+    ("Refill", "A subsequent dispensing of a medication previously authorized by a prescription."),
+    ("Medical Advice", "Recommendations regarding diagnosis, treatment, or prevention of medical conditions. You are strictly prohibited from providing medical advice. Always refer the user to a qualified healthcare professional."),
+    ("Side Effects", "Unintended secondary effects which a drug or medical treatment has on the body. Only provide information listed in the approved drug info."),
+    ("Contraindications", "Specific situations in which a drug should not be used because it may be harmful to the person. Only provide information listed in the approved drug info."),
+    ("Pharmacist", "A licensed healthcare professional specializing in medication dispensing and counseling. Human pharmacists are available for complex questions."),
+    ("Pharmacy Phone Number", "Our pharmacy phone number is +1-800-PHARMA-1."),
+    ("Pharmacy Hours", "We are open Monday to Friday, 9 AM to 7 PM, and Saturday 10 AM to 4 PM. Closed Sundays."),
+]
+
 async def add_domain_glossary(agent: p.Agent):
     """Adds domain-specific terms to the agent's glossary."""
-    logging.info("Adding glossary terms...")
-    await agent.create_term(
-        name="Prescription",
-        description="An instruction written by a medical practitioner that authorizes a patient to be provided a medicine or treatment."
-    )
-    await agent.create_term(
-        name="Refill",
-        description="A subsequent dispensing of a medication previously authorized by a prescription."
-    )
-    await agent.create_term(
-        name="Medical Advice",
-        description="Recommendations regarding diagnosis, treatment, or prevention of medical conditions. You are strictly prohibited from providing medical advice. Always refer the user to a qualified healthcare professional."
-    )
-    await agent.create_term(
-         name="Side Effects",
-         description="Unintended secondary effects which a drug or medical treatment has on the body. Only provide information listed in the approved drug info."
-    )
-    await agent.create_term(
-         name="Contraindications",
-         description="Specific situations in which a drug should not be used because it may be harmful to the person. Only provide information listed in the approved drug info."
-    )
-    await agent.create_term(
-         name="Pharmacist",
-         description="A licensed healthcare professional specializing in medication dispensing and counseling. Human pharmacists are available for complex questions."
-    )
-    await agent.create_term(
-         name="Pharmacy Phone Number",
-         description="Our pharmacy phone number is +1-800-PHARMA-1."
-    )
-    await agent.create_term(
-         name="Pharmacy Hours",
-         description="We are open Monday to Friday, 9 AM to 7 PM, and Saturday 10 AM to 4 PM. Closed Sundays."
-    )
+    logger.info("Adding glossary terms...")
+    # Terms are independent of each other, so create them concurrently
+    await _gather(*[agent.create_term(name=name, description=description) for name, description in _TERMS])
+
+
+# Global guidelines as (condition, action, metadata) triples
+_GUIDELINES: list[tuple[str, str, dict[str, p.JSONSerializable]]] = [
+    # Medical Advice Guideline (High Priority)
+    (
+        "Customer asks for medical advice, diagnosis, dosage recommendations (not related to a specific order confirmation), or treatment suggestions",
+        "CRITICAL: Immediately and politely refuse. State you are an AI assistant and legally cannot provide medical advice. Recommend they consult their doctor or pharmacist using the Pharmacy Phone Number.",
+        {"priority": 10},
+    ),
+    # Drug Interaction Guideline
+    (
+        "Customer asks about specific drug interactions",
+        "Politely refuse. State that drug interactions are complex and potentially dangerous, and must be discussed with a qualified pharmacist or doctor who knows their full medical history. Offer Pharmacy Phone Number.",
+        {"priority": 9},
+    ),
+    # Severe Symptoms Guideline (Highest Priority)
+    (
+        "Customer describes severe symptoms or distress (e.g., 'severe pain', 'trouble breathing', 'allergic reaction', 'feeling faint')",
+        "Express empathy briefly. STOP the current process. Strongly advise seeking immediate medical attention (e.g., 'For symptoms like that, please contact emergency services or your doctor right away.') Offer emergency contact info if configured.",
+        {"priority": 11},
+    ),
+    # Off-Topic Guideline
+    (
+        "Customer asks a question unrelated to pharmacy services, ordering, medication info, or operating hours/contact",
+        "Politely redirect the conversation back to pharmacy-related topics. State your purpose (e.g., 'I can help with medication orders, provide basic drug information, check order status, and give our hours. How can I assist you with those today?').",
+        {},
+    ),
+    # Missing Prescription Guideline (specific to order context, but can be global)
+    (
+        "Customer asks to order a medication identified by 'check_stock' as requiring a prescription, but does not provide a reference",
+        "Inform them the medication requires a valid prescription reference number to proceed with an order. Ask if they have one.",
+        {}, # This might be better handled within the journey, but can be a global fallback
+    ),
+    # Frustration/Confusion Guideline
+    (
+        "Customer expresses significant frustration, confusion, or repeats the same failed request",
+        "Respond with empathy and patience. Offer to clarify or try explaining differently. Ask if they would prefer to speak with a human pharmacist via the Pharmacy Phone Number.",
+        {},
+    ),
+    # Explicit Human Handoff Request Guideline
+    (
+        "Customer explicitly asks to speak to a human, agent, or pharmacist",
+        "Acknowledge the request. Provide the Pharmacy Phone Number and Pharmacy Hours. State that a human pharmacist can provide further assistance. [System Note: Log Handoff Request]",
+        {"priority": 8},
+    ),
+    # Implicit Handoff (Complex/Sensitive/Stuck) Guideline
+    (
+        "Conversation involves complex issues beyond tool capabilities OR agent is stuck in a loop OR detects high user distress not covered by severe symptoms guideline",
+        "Politely state the limitation. Offer to connect them with a human pharmacist. Provide Pharmacy Phone Number and Pharmacy Hours. [System Note: Log Implicit Handoff Trigger]",
+        {"priority": 7}, # Lower than explicit request
+    ),
+]
+
+async def add_global_guidelines(agent: p.Agent):
+    """Adds the global, always-active guidelines to the agent."""
+    logger.info("Adding global guidelines...")
+    # Guidelines are independent of each other, so create them concurrently
+    await _gather(*[
+        agent.create_guideline(condition=condition, action=action, metadata=metadata)
+        for condition, action, metadata in _GUIDELINES
+    ])
+    logger.info("Guidelines added.")
+
+
+async def _wire_disambiguation(agent: p.Agent, order_task: asyncio.Task, status_task: asyncio.Task):
+    """Links the ambiguous 'order' observation to the new-order and order-status journeys."""
+    # Example: User asks "Can you help with my Lisinopril order?" (New order or status check?)
+    # The observation is created while the journeys are still being built.
+    order_inquiry = await agent.create_observation(
+         "The customer mentions a specific medication and the word 'order', but it's unclear if they want to place a new one or check an existing one."
+    )
+    # Link the observation to relevant journeys once they exist
+    await order_inquiry.disambiguate([await order_task, await status_task])
 
 
 # --- 4. Main Application Logic ---
 
-async def main():
-    """Initializes and runs the Parlant server and agent."""
-    logging.info("Starting PharmaPal agent setup...")
-    # Example: configure OpenAI using environment variable loaded by dotenv
-    # You might need to install openai package: pip install openai
-    # p.configure_openai() # Reads OPENAI_API_KEY from env if available
-
-    async with p.Server() as server:
-        logging.info(f"Parlant server started on port {server.port}")
-        agent = await server.create_agent(
-            name="PharmaPal",
-            description="""You are PharmaPal, a helpful and compliant pharmacy sales assistant AI.
+# Agent description (sent as part of every system prompt). Whitespace is
+# compacted once at import: runs of spaces collapse and blank lines are
+# dropped, while line breaks are kept so each rule stays its own bullet.
+AGENT_DESCRIPTION = re.sub(r"\s*\n\s*", "\n", re.sub(r"[ \t]+", " ", textwrap.dedent("""\
+You are PharmaPal, a helpful and compliant pharmacy sales assistant AI.
 Your primary functions are assisting customers with medication orders, checking stock/prescription needs, providing basic approved drug info, checking order status, and answering simple refill questions.
 You are professional, empathetic, accurate, and patient. Compliance and safety are critical.
 
@@ -447,91 +607,58 @@ You are professional, empathetic, accurate, and patient. Compliance and safety a
 * **DRUG INTERACTIONS/SEVERE SYMPTOMS:** Do not attempt to analyze drug interactions or severe symptoms. For interactions, refer to a pharmacist/doctor. For severe symptoms, express empathy, stop the process, and strongly advise seeking immediate medical attention or contacting emergency services.
 * **PRESCRIPTIONS:** If a drug requires a prescription per the `check_stock` tool, always verify it using the `verify_prescription` tool before proceeding with an order.
 * **HUMAN HANDOFF:** If requested, or if the situation is complex, sensitive, requires professional judgment, or you are unable to proceed, offer to connect the user to a human pharmacist.
-""",
+""").strip()))
+
+async def main():
+    """Initializes and runs the Parlant server and agent."""
+    logger.info("Starting PharmaPal agent setup...")
+    # Example: configure OpenAI using environment variable loaded by dotenv
+    # You might need to install openai package: pip install openai
+    # p.configure_openai() # Reads OPENAI_API_KEY from env if available
+
+    async with p.Server() as server:
+        logger.info("Parlant server started on port %s", server.port)
+        agent = await server.create_agent(
+            name="PharmaPal",
+            description=AGENT_DESCRIPTION,
             # model="gpt-4o" # Specify model if needed
         )
-        logging.info(f"Agent '{agent.name}' created.")
+        logger.info("Agent '%s' created.", agent.name)
 
         # Tools decorated with @p.tool are automatically discovered.
-        logging.info("Tools discovered automatically by Parlant.")
+        logger.info("Tools discovered automatically by Parlant.")
 
-        # Add Glossary
+        # Add Glossary (before journeys, so the terms are in place when they're created)
         await add_domain_glossary(agent)
 
-        # Create Journeys
-        logging.info("Creating journeys...")
-        order_journey = await create_new_order_journey(agent)
-        info_journey = await create_drug_info_journey(agent)
-        status_journey = await create_order_status_journey(agent)
-        # Add Refill Journey creation call here if implemented
-        logging.info("Journeys created.")
-
-        # --- Disambiguation for Ambiguous Requests ---
-        # Example: User asks "Can you help with my Lisinopril order?" (New order or status check?)
-        order_inquiry = await agent.create_observation(
-             "The customer mentions a specific medication and the word 'order', but it's unclear if they want to place a new one or check an existing one."
-        )
-        # Link the observation to relevant journeys
-        await order_inquiry.disambiguate([order_journey, status_journey])
-
-
-        # --- Global Guidelines ---
-        logging.info("Adding global guidelines...")
-        # Medical Advice Guideline (High Priority)
-        await agent.create_guideline(
-            condition="Customer asks for medical advice, diagnosis, dosage recommendations (not related to a specific order confirmation), or treatment suggestions",
-            action="CRITICAL: Immediately and politely refuse. State you are an AI assistant and legally cannot provide medical advice. Recommend they consult their doctor or pharmacist using the Pharmacy Phone Number.",
-            metadata={"priority": 10}
-        )
-        # Drug Interaction Guideline
-        await agent.create_guideline(
-            condition="Customer asks about specific drug interactions",
-            action="Politely refuse. State that drug interactions are complex and potentially dangerous, and must be discussed with a qualified pharmacist or doctor who knows their full medical history. Offer Pharmacy Phone Number.",
-            metadata={"priority": 9}
-        )
-        # Severe Symptoms Guideline (Highest Priority)
-        await agent.create_guideline(
-            condition="Customer describes severe symptoms or distress (e.g., 'severe pain', 'trouble breathing', 'allergic reaction', 'feeling faint')",
-            action="Express empathy briefly. STOP the current process. Strongly advise seeking immediate medical attention (e.g., 'For symptoms like that, please contact emergency services or your doctor right away.') Offer emergency contact info if configured.",
-            metadata={"priority": 11}
-        )
-        # Off-Topic Guideline
-        await agent.create_guideline(
-            condition="Customer asks a question unrelated to pharmacy services, ordering, medication info, or operating hours/contact",
-            action="Politely redirect the conversation back to pharmacy-related topics. State your purpose (e.g., 'I can help with medication orders, provide basic drug information, check order status, and give our hours. How can I assist you with those today?')."
-        )
-        # Missing Prescription Guideline (specific to order context, but can be global)
-        await agent.create_guideline(
-            condition="Customer asks to order a medication identified by 'check_stock' as requiring a prescription, but does not provide a reference",
-            action="Inform them the medication requires a valid prescription reference number to proceed with an order. Ask if they have one.",
-            # This might be better handled within the journey, but can be a global fallback
-        )
-        # Frustration/Confusion Guideline
-        await agent.create_guideline(
-            condition="Customer expresses significant frustration, confusion, or repeats the same failed request",
-            action="Respond with empathy and patience. Offer to clarify or try explaining differently. Ask if they would prefer to speak with a human pharmacist via the Pharmacy Phone Number."
-        )
-        # Explicit Human Handoff Request Guideline
-        await agent.create_guideline(
-            condition="Customer explicitly asks to speak to a human, agent, or pharmacist",
-            action="Acknowledge the request. Provide the Pharmacy Phone Number and Pharmacy Hours. State that a human pharmacist can provide further assistance. [System Note: Log Handoff Request]",
-            metadata={"priority": 8}
-        )
-        # Implicit Handoff (Complex/Sensitive/Stuck) Guideline
-        await agent.create_guideline(
-            condition="Conversation involves complex issues beyond tool capabilities OR agent is stuck in a loop OR detects high user distress not covered by severe symptoms guideline",
-            action="Politely state the limitation. Offer to connect them with a human pharmacist. Provide Pharmacy Phone Number and Pharmacy Hours. [System Note: Log Implicit Handoff Trigger]",
-            metadata={"priority": 7} # Lower than explicit request
-        )
-        logging.info("Guidelines added.")
+        # Create Journeys (independent of each other, so created concurrently).
+        # The task group cancels everything still running if any step fails, and
+        # the failing step's exception is re-raised rather than its ExceptionGroup.
+        logger.info("Creating journeys...")
+        try:
+            async with asyncio.TaskGroup() as tg:
+                order_task = tg.create_task(create_new_order_journey(agent))
+                tg.create_task(create_drug_info_journey(agent))
+                status_task = tg.create_task(create_order_status_journey(agent))
+                # Add Refill Journey creation call here if implemented
+
+                # --- Disambiguation for Ambiguous Requests ---
+                # Wired up as soon as the two journeys it references exist, while the
+                # info journey and the global guidelines are still being created.
+                tg.create_task(_wire_disambiguation(agent, order_task, status_task))
+
+                # --- Global Guidelines ---
+                tg.create_task(add_global_guidelines(agent))
+        except BaseExceptionGroup as group:
+            raise _first_leaf(group) from group
+        logger.info("Journeys, disambiguation and guidelines created.")
 
         print("\n--- PharmaPal Sales Bot Ready! ---")
         print(f"Parlant UI likely available at: http://localhost:{server.port}")
         print("Press Ctrl+C to stop.")
 
-    # The SDK's Server does not expose `serve_forever()`; use a simple
-    # event wait to keep the context alive until interrupted by the user.
-    await asyncio.Event().wait()
+    # Nothing to wait on here: the Server starts serving, and keeps serving
+    # until interrupted, when the `async with` block exits.
 
 
 if __name__ == "__main__":
@@ -541,4 +668,4 @@ if __name__ == "__main__":
         print("\nServer stopped by user.")
     except Exception as e:
         print(f"\nAn unexpected error occurred: {e}")
-        logging.exception("Unhandled exception occurred during main execution.")
\ No newline at end of file
+        logger.exception("Unhandled exception occurred during main execution.")
\ No newline at end of file